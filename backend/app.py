@@ -1,6 +1,12 @@
-from flask import Flask, request, jsonify, send_file # ¡Añadir Flask aquí!
+from flask import Flask, request, jsonify, send_file, g # ¡Añadir Flask aquí!
 from flask_cors import CORS
-from backend.data_processor import process_data_for_export, generate_shipping_label_zpl
+from backend.data_processor import process_data_for_export, generate_shipping_label_zpl, get_export_cache_info, get_tiendanube_sync
+from backend.print_spooler import get_print_spooler
+from backend.snapshot_store import get_snapshot_store, compare_snapshots
+from backend.circuit_breaker import (
+    REQUEST_DEADLINE_SECONDS, UpstreamUnavailableError, breakers_status,
+    set_request_deadline, reset_request_deadline
+)
 import io
 import logging
 
@@ -9,6 +15,20 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 app = Flask(__name__) # Esta línea ahora funcionará
 CORS(app) # Habilitar CORS para todas las rutas
 
+@app.before_request
+def start_request_deadline():
+    # Las llamadas a SOAP/TiendaNube de esta solicitud no pueden exceder este plazo
+    seconds = request.headers.get('X-Plazo-Segundos', type=float)
+    if seconds is None or seconds <= 0 or seconds > REQUEST_DEADLINE_SECONDS:
+        seconds = REQUEST_DEADLINE_SECONDS
+    g.deadline_token = set_request_deadline(seconds)
+
+@app.teardown_request
+def end_request_deadline(exc):
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        reset_request_deadline(token)
+
 @app.route('/')
 def hello_world():
     return '¡Hola desde Flask!'
@@ -20,49 +40,67 @@ def get_pedidos(export_id):
         # ¡CAMBIO CLAVE! Ahora data es una lista de todos los pedidos
         data = process_data_for_export(export_id)
         if data:
-            return jsonify(data) # Devuelve la lista completa
+            response = jsonify(data) # Devuelve la lista completa
+            cache_info = get_export_cache_info(export_id)
+            if cache_info:
+                # Metadatos en cabeceras para no cambiar el formato de la lista que consume el frontend
+                response.headers['X-Datos-Obtenidos'] = str(cache_info['fetched_at'])
+                response.headers['X-Datos-Desde-Snapshot'] = '1' if cache_info['from_snapshot'] else '0'
+                response.headers['X-Datos-Refrescando'] = '1' if cache_info['refreshing'] else '0'
+                response.headers['X-Datos-Desactualizados'] = '1' if cache_info['stale'] else '0'
+            return response
         else:
             return jsonify({"message": "No se encontraron datos para el ID de exportación proporcionado."}), 404
+    except UpstreamUnavailableError as e:
+        logging.warning(f"ERP no disponible para export_id {export_id} y sin datos en caché: {e}")
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         logging.error(f"Error al procesar datos para export_id {export_id}: {e}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/pedidos/label_zpl/<int:export_id>/<int:order_id>/<int:num_bultos>', methods=['GET'])
-def get_zpl_label(export_id, order_id, num_bultos):
-    logging.info(f"Solicitud de etiqueta ZPL recibida para Pedido SOH: {order_id}, Export ID: {export_id}, Bultos: {num_bultos}")
-    
+def _build_zpl_labels(export_id, order_id, num_bultos):
+    # Devuelve (etiquetas, None) o (None, respuesta_de_error) para reutilizar en descarga e impresión directa
     manual_tipo_envio_etiqueta = request.args.get('tipo_envio_etiqueta', type=str)
     manual_tipo_domicilio = request.args.get('tipo_domicilio', type=str)
 
     logging.info(f"Parámetros ZPL manuales recibidos: TipoEnvio='{manual_tipo_envio_etiqueta}', TipoDomicilio='{manual_tipo_domicilio}'")
 
-    try:
-        # Obtener TODOS los pedidos para el export_id
-        all_orders_for_export = process_data_for_export(export_id)
-        
-        if not all_orders_for_export:
-            logging.warning(f"No se encontraron datos para el export_id {export_id} al generar la etiqueta ZPL.")
-            return jsonify({"error": "Datos del pedido no encontrados."}), 404
-        
-        # Buscar el pedido específico por IDPedido dentro de la lista obtenida
-        fetched_order_data = next((order for order in all_orders_for_export if order.get('IDPedido') == order_id), None)
-
-        if fetched_order_data is None:
-            logging.warning(f"No se encontró el pedido con IDPedido {order_id} en los datos para export_id {export_id}.")
-            return jsonify({"error": f"Pedido con ID {order_id} no encontrado para el ID de exportación {export_id}."}), 404
-
-
-        # Generar la etiqueta ZPL, pasando los parámetros manuales
-        zpl_labels = generate_shipping_label_zpl(
-            fetched_order_data, 
-            total_bultos=num_bultos, 
-            manual_tipo_envio_etiqueta=manual_tipo_envio_etiqueta, 
-            manual_tipo_domicilio=manual_tipo_domicilio
-        )
+    # Obtener TODOS los pedidos para el export_id
+    all_orders_for_export = process_data_for_export(export_id)
+
+    if not all_orders_for_export:
+        logging.warning(f"No se encontraron datos para el export_id {export_id} al generar la etiqueta ZPL.")
+        return None, (jsonify({"error": "Datos del pedido no encontrados."}), 404)
+
+    # Buscar el pedido específico por IDPedido dentro de la lista obtenida
+    fetched_order_data = next((order for order in all_orders_for_export if order.get('IDPedido') == order_id), None)
+
+    if fetched_order_data is None:
+        logging.warning(f"No se encontró el pedido con IDPedido {order_id} en los datos para export_id {export_id}.")
+        return None, (jsonify({"error": f"Pedido con ID {order_id} no encontrado para el ID de exportación {export_id}."}), 404)
+
+    # Generar la etiqueta ZPL, pasando los parámetros manuales
+    zpl_labels = generate_shipping_label_zpl(
+        fetched_order_data,
+        total_bultos=num_bultos,
+        manual_tipo_envio_etiqueta=manual_tipo_envio_etiqueta,
+        manual_tipo_domicilio=manual_tipo_domicilio
+    )
+
+    if not zpl_labels:
+        logging.warning(f"No se generó ninguna etiqueta ZPL para el pedido {order_id}, Export ID {export_id}.")
+        return None, (jsonify({"error": "No se pudo generar la etiqueta ZPL."}), 500)
 
-        if not zpl_labels:
-            logging.warning(f"No se generó ninguna etiqueta ZPL para el pedido {order_id}, Export ID {export_id}.")
-            return jsonify({"error": "No se pudo generar la etiqueta ZPL."}), 500
+    return zpl_labels, None
+
+@app.route('/api/pedidos/label_zpl/<int:export_id>/<int:order_id>/<int:num_bultos>', methods=['GET'])
+def get_zpl_label(export_id, order_id, num_bultos):
+    logging.info(f"Solicitud de etiqueta ZPL recibida para Pedido SOH: {order_id}, Export ID: {export_id}, Bultos: {num_bultos}")
+
+    try:
+        zpl_labels, error_response = _build_zpl_labels(export_id, order_id, num_bultos)
+        if error_response:
+            return error_response
 
         full_zpl_content = "\n".join(zpl_labels)
 
@@ -77,6 +115,93 @@ def get_zpl_label(export_id, order_id, num_bultos):
         logging.error(f"Error al generar la etiqueta ZPL para pedido {order_id}, Export ID {export_id}: {e}", exc_info=True)
         return jsonify({"error": f"Error interno del servidor al generar la etiqueta ZPL: {e}"}), 500
 
+@app.route('/api/pedidos/print_zpl/<int:export_id>/<int:order_id>/<int:num_bultos>', methods=['POST'])
+def print_zpl_label(export_id, order_id, num_bultos):
+    printer_name = request.args.get('impresora', type=str)
+    logging.info(f"Solicitud de impresión directa para Pedido SOH: {order_id}, Export ID: {export_id}, Bultos: {num_bultos}, Impresora: {printer_name}")
+
+    spooler = get_print_spooler()
+    if spooler is None:
+        return jsonify({"error": "Cola de impresión no disponible."}), 503
+    if not printer_name:
+        if len(spooler.printers) != 1:
+            return jsonify({"error": "Debe indicar la impresora con el parámetro 'impresora'."}), 400
+        printer_name = next(iter(spooler.printers))
+    if printer_name not in spooler.printers:
+        return jsonify({"error": f"Impresora '{printer_name}' no configurada."}), 404
+
+    try:
+        zpl_labels, error_response = _build_zpl_labels(export_id, order_id, num_bultos)
+        if error_response:
+            return error_response
+
+        job = spooler.submit(printer_name, zpl_labels, descripcion=f"ExpID{export_id} SOH{order_id}")
+        return jsonify(job), 202
+
+    except Exception as e:
+        logging.error(f"Error al encolar la etiqueta ZPL para pedido {order_id}, Export ID {export_id}: {e}", exc_info=True)
+        return jsonify({"error": f"Error interno del servidor al encolar la etiqueta ZPL: {e}"}), 500
+
+@app.route('/api/impresion/trabajos/<job_id>', methods=['GET'])
+def get_print_job(job_id):
+    spooler = get_print_spooler()
+    if spooler is None:
+        return jsonify({"error": "Cola de impresión no disponible."}), 503
+    job = spooler.get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"Trabajo de impresión {job_id} no encontrado."}), 404
+    return jsonify(job)
+
+@app.route('/api/impresion/estado', methods=['GET'])
+def get_print_status():
+    spooler = get_print_spooler()
+    if spooler is None:
+        return jsonify({"error": "Cola de impresión no disponible."}), 503
+    return jsonify(spooler.status())
+
+@app.route('/api/pedidos/<int:export_id>/historial', methods=['GET'])
+def get_export_history(export_id):
+    store = get_snapshot_store()
+    if store is None:
+        return jsonify({"error": "Almacén de snapshots no disponible."}), 503
+    return jsonify(store.list_snapshots(export_id))
+
+@app.route('/api/pedidos/<int:export_id>/historial/comparar', methods=['GET'])
+def compare_export_history(export_id):
+    store = get_snapshot_store()
+    if store is None:
+        return jsonify({"error": "Almacén de snapshots no disponible."}), 503
+
+    # Por defecto compara los dos últimos snapshots
+    desde_id = request.args.get('desde', type=int)
+    hasta_id = request.args.get('hasta', type=int)
+    if desde_id is None or hasta_id is None:
+        snapshots = store.list_snapshots(export_id)
+        if len(snapshots) < 2:
+            return jsonify({"error": "No hay suficientes snapshots para comparar."}), 404
+        hasta_id = hasta_id if hasta_id is not None else snapshots[0]['id']
+        desde_id = desde_id if desde_id is not None else snapshots[1]['id']
+
+    desde = store.load(export_id, desde_id)
+    hasta = store.load(export_id, hasta_id)
+    if desde is None or hasta is None:
+        return jsonify({"error": "Snapshot no encontrado para el ID de exportación proporcionado."}), 404
+
+    result = compare_snapshots(desde['orders'], hasta['orders'])
+    result.update({'desde': desde_id, 'hasta': hasta_id})
+    return jsonify(result)
+
+@app.route('/api/tiendanube/sincronizacion', methods=['GET'])
+def get_tiendanube_sync_status():
+    tn_sync = get_tiendanube_sync()
+    if tn_sync is None:
+        return jsonify({"error": "Sincronización de TiendaNube no disponible."}), 503
+    return jsonify(tn_sync.status())
+
+@app.route('/api/metricas', methods=['GET'])
+def get_metrics():
+    return jsonify({"circuitos": breakers_status()})
+
 @app.route("/reintentar-cliente-soap", methods=["POST"])
 def reiniciar_cliente_soap():
     from backend.data_processor import get_soap_client
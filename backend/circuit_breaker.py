@@ -0,0 +1,251 @@
+import collections
+import contextlib
+import contextvars
+import logging
+import os
+import threading
+import time
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STATE_CLOSED = "cerrado"
+STATE_OPEN = "abierto"
+STATE_HALF_OPEN = "semiabierto"
+
+# Muestras de latencia necesarias antes de ajustar el timeout
+MIN_LATENCY_SAMPLES = 20
+# El timeout adaptativo es el p99 observado multiplicado por este factor
+LATENCY_TIMEOUT_MULTIPLIER = 2.0
+# Plazo por defecto de una solicitud HTTP entrante; el cliente puede pedir uno menor con X-Plazo-Segundos
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "150"))
+# Si queda menos que esto del plazo de la solicitud, no vale la pena llamar al upstream
+MIN_CALL_SECONDS = 1.0
+
+# Momento (time.monotonic) en que vence la solicitud HTTP en curso; None fuera de una solicitud
+_request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class UpstreamUnavailableError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+
+class DeadlineExceededError(UpstreamUnavailableError):
+    pass
+
+
+class UpstreamFailedError(UpstreamUnavailableError):
+    # Se agotaron los reintentos por timeouts o errores de red antes de que el circuito se abriera
+    pass
+
+
+def set_request_deadline(seconds: float):
+    return _request_deadline.set(time.monotonic() + seconds)
+
+
+def reset_request_deadline(token):
+    _request_deadline.reset(token)
+
+
+def remaining_request_time():
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    # Los 4xx son respuestas válidas de un upstream sano; sólo cuentan timeouts, errores de red y 5xx
+    if isinstance(exc, requests.exceptions.HTTPError):
+        return exc.response is None or exc.response.status_code >= 500
+    return isinstance(exc, requests.exceptions.RequestException)
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    """Circuit breaker por upstream con timeout adaptativo.
+
+    Tras failure_threshold fallos seguidos se abre y rechaza las llamadas al
+    instante. Pasado recovery_timeout deja pasar una única llamada de prueba
+    (semiabierto): si sale bien se cierra, si falla vuelve a abrirse.
+
+    El estado del circuito es del upstream, pero la latencia se mide por
+    operación: una autenticación o una orden suelta no tardan lo mismo que la
+    exportación completa o una página de 200 órdenes.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 min_timeout: float = 1, max_timeout: float = 30, latency_window: int = 200):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.total_calls = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+        self._probe_in_flight = False
+        self.latency_window = latency_window
+        self._latencies = {}  # operación -> deque de latencias
+        self._operation_caps = {}  # operación -> max_timeout con que se la llama
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        # Abierto y todavía dentro del período de espera: las llamadas se rechazarían sin bloquear
+        with self._lock:
+            return self.state == STATE_OPEN and time.monotonic() - self.opened_at < self.recovery_timeout
+
+    def _allow_request(self) -> tuple:
+        # Devuelve (permitida, es_llamada_de_prueba)
+        with self._lock:
+            if self.state == STATE_OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = STATE_HALF_OPEN
+                logging.info(f"Circuito '{self.name}' semiabierto: se permite una llamada de prueba.")
+            if self.state == STATE_CLOSED:
+                return True, False
+            if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True, True
+            self.total_rejected += 1
+            return False, False
+
+    def _record_success(self, operation: str, latency: float):
+        with self._lock:
+            self._latencies.setdefault(operation, collections.deque(maxlen=self.latency_window)).append(latency)
+            self.total_calls += 1
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            if self.state != STATE_CLOSED:
+                logging.info(f"Circuito '{self.name}' cerrado: el upstream volvió a responder.")
+            self.state = STATE_CLOSED
+
+    def _record_failure(self, operation: str, timed_out_after: float = None):
+        with self._lock:
+            if timed_out_after is not None:
+                # El timeout es una cota inferior de la latencia real: sumarlo a la ventana deja que el p99
+                # vuelva a crecer si el upstream se pone más lento de forma sostenida
+                self._latencies.setdefault(operation, collections.deque(maxlen=self.latency_window)).append(timed_out_after)
+            self.total_calls += 1
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != STATE_OPEN:
+                    logging.warning(f"Circuito '{self.name}' abierto tras {self.consecutive_failures} fallo(s) seguidos. Se reintentará en {self.recovery_timeout} segundos.")
+                self.state = STATE_OPEN
+                self.opened_at = time.monotonic()
+
+    def _release_probe(self):
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _latency_values(self, operation: str) -> list:
+        with self._lock:
+            return sorted(self._latencies.get(operation, ()))
+
+    def latency_percentiles(self, operation: str) -> dict:
+        values = self._latency_values(operation)
+        if not values:
+            return {'p50': None, 'p95': None, 'p99': None}
+        return {p: round(_percentile(values, float(p[1:])), 3) for p in ('p50', 'p95', 'p99')}
+
+    def _operation_cap(self, max_timeout: float = None) -> float:
+        return min(max_timeout, self.max_timeout) if max_timeout is not None else self.max_timeout
+
+    def current_timeout(self, operation: str, max_timeout: float = None) -> float:
+        cap = self._operation_cap(max_timeout)
+        values = self._latency_values(operation)
+        if len(values) < MIN_LATENCY_SAMPLES:
+            return cap
+        return max(self.min_timeout, min(cap, _percentile(values, 99) * LATENCY_TIMEOUT_MULTIPLIER))
+
+    @contextlib.contextmanager
+    def guard(self, operation: str, max_timeout: float = None):
+        """Protege una llamada al upstream y entrega el timeout a usar.
+
+            with breaker.guard('orden', max_timeout=10) as timeout:
+                response = requests.get(url, timeout=timeout)
+        """
+        self._operation_caps[operation] = max_timeout
+        remaining = remaining_request_time()
+        if remaining is not None and remaining < MIN_CALL_SECONDS:
+            raise DeadlineExceededError(f"Plazo de la solicitud agotado antes de llamar a '{self.name}'.")
+
+        allowed, is_probe = self._allow_request()
+        if not allowed:
+            raise CircuitOpenError(f"Circuito '{self.name}' abierto: no se consulta el upstream.")
+
+        # La llamada de prueba usa el tope completo de la operación: con el timeout adaptativo un upstream
+        # que se volvió más lento fallaría todas las pruebas y el circuito no se cerraría nunca
+        timeout = self._operation_cap(max_timeout) if is_probe else self.current_timeout(operation, max_timeout)
+        limited_by_deadline = False
+        if remaining is not None and remaining < timeout:
+            timeout = remaining
+            limited_by_deadline = True
+
+        start = time.monotonic()
+        try:
+            yield timeout
+        except BaseException as e:
+            if limited_by_deadline and isinstance(e, requests.exceptions.Timeout):
+                # El timeout lo puso el plazo de la solicitud (que el cliente puede acortar), no la
+                # latencia del upstream: no cuenta como fallo
+                self._release_probe()
+                raise DeadlineExceededError(f"Plazo de la solicitud agotado esperando a '{self.name}'.") from e
+            if is_upstream_failure(e):
+                self._record_failure(operation, timeout if isinstance(e, requests.exceptions.Timeout) else None)
+            elif isinstance(e, requests.exceptions.HTTPError):
+                self._record_success(operation, time.monotonic() - start)
+            else:
+                self._release_probe()
+            raise
+        else:
+            self._record_success(operation, time.monotonic() - start)
+
+    def has_time_for(self, operation: str, max_timeout: float = None) -> bool:
+        # ¿Alcanza lo que queda del plazo de la solicitud para una llamada completa a esta operación?
+        remaining = remaining_request_time()
+        return remaining is None or remaining >= self.current_timeout(operation, max_timeout)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            state = self.state
+            opened_for = time.monotonic() - self.opened_at if self.opened_at is not None and state == STATE_OPEN else None
+            data = {
+                'estado': state,
+                'fallos_consecutivos': self.consecutive_failures,
+                'llamadas': self.total_calls,
+                'fallos': self.total_failures,
+                'rechazadas': self.total_rejected,
+                'abierto_hace_s': round(opened_for, 1) if opened_for is not None else None,
+            }
+        with self._lock:
+            operations = sorted(set(self._latencies) | set(self._operation_caps))
+        data['operaciones'] = {
+            operation: {
+                'latencia_s': self.latency_percentiles(operation),
+                'timeout_actual_s': round(self.current_timeout(operation, self._operation_caps.get(operation)), 2),
+            }
+            for operation in operations
+        }
+        return data
+
+
+soap_breaker = CircuitBreaker("soap", failure_threshold=3, recovery_timeout=60, min_timeout=15, max_timeout=120)
+tiendanube_breaker = CircuitBreaker("tiendanube", failure_threshold=5, recovery_timeout=30, min_timeout=2, max_timeout=30)
+
+def breakers_status() -> dict:
+    return {breaker.name: breaker.to_dict() for breaker in (soap_breaker, tiendanube_breaker)}
@@ -8,7 +8,12 @@ import re
 from flask import render_template_string, current_app
 import datetime # Importar datetime al inicio del archivo
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from backend.snapshot_store import get_snapshot_store, SNAPSHOT_MAX_AGE_SECONDS
+from backend.tiendanube_sync import TiendaNubeSync
+from backend.circuit_breaker import soap_breaker, tiendanube_breaker, UpstreamUnavailableError, UpstreamFailedError
 
 # Cargar variables del archivo .env
 load_dotenv()
@@ -58,8 +63,9 @@ class TiendaNubeClient:
         url = f"{self.base_url}/orders/{order_id}"
         logging.info(f"Consultando TiendaNube para orden: {order_id} en {url}")
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
+            with tiendanube_breaker.guard('orden', max_timeout=10) as timeout:
+                response = requests.get(url, headers=self.headers, timeout=timeout)
+                response.raise_for_status()
             order_data = response.json()
             logging.info(f"Datos de TiendaNube para orden {order_id} obtenidos exitosamente.")
             return order_data
@@ -75,10 +81,43 @@ class TiendaNubeClient:
         except requests.exceptions.RequestException as e:
             logging.error(f"Error desconocido al consultar TiendaNube para la orden {order_id}: {e}")
             return {}
+        except UpstreamUnavailableError:
+            raise # Circuito abierto o plazo agotado: quien llama debe saber que la orden quedó sin consultar
         except Exception as e:
             logging.error(f"Error inesperado en get_order_details para orden {order_id}: {e}")
             return {}
 
+    def list_orders(self, updated_at_min: str, page: int = 1, per_page: int = 200):
+        # Devuelve la lista de órdenes de la página, o None si la consulta falló
+        url = f"{self.base_url}/orders"
+        params = {
+            "updated_at_min": updated_at_min,
+            "page": page,
+            "per_page": per_page,
+            "fields": "id,number,updated_at,shipping_address",
+        }
+        logging.info(f"Listando órdenes de TiendaNube modificadas desde {updated_at_min} (página {page}).")
+        try:
+            with tiendanube_breaker.guard('listado') as timeout:
+                response = requests.get(url, headers=self.headers, params=params, timeout=timeout)
+                if response.status_code == 404:
+                    # TiendaNube responde 404 ("Last page is N") cuando la página no tiene órdenes, incluso la primera
+                    return []
+                response.raise_for_status()
+            return response.json()
+        except requests.exceptions.HTTPError as e:
+            logging.error(f"Error HTTP al listar órdenes de TiendaNube (página {page}): {e.response.status_code} - {e.response.text}")
+            return None
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error al listar órdenes de TiendaNube (página {page}): {e}")
+            return None
+        except UpstreamUnavailableError as e:
+            logging.warning(f"No se listaron órdenes de TiendaNube (página {page}): {e}")
+            return None
+        except Exception as e:
+            logging.error(f"Error inesperado en list_orders (página {page}): {e}")
+            return None
+
 
 class SoapClient:
     def __init__(self, url_ws, username, password, company, webservice_name):
@@ -115,11 +154,14 @@ class SoapClient:
         header_ws = {"Content-Type": "text/xml", "SOAPAction": soap_action, "muteHttpExceptions": "true"}
 
         logging.info("Intentando autenticar con el servicio SOAP...")
+        response = None
+        timeout = None
         try:
-            response = requests.post(self.url_ws, data=xml_payload.encode('utf-8'), headers=header_ws, timeout=30)
-            response.raise_for_status()
+            with soap_breaker.guard('autenticacion', max_timeout=30) as timeout:
+                response = requests.post(self.url_ws, data=xml_payload.encode('utf-8'), headers=header_ws, timeout=timeout)
+                response.raise_for_status()
         except requests.exceptions.Timeout:
-            logging.error(f"Timeout durante la autenticación después de 30 segundos.")
+            logging.error(f"Timeout durante la autenticación después de {timeout:.0f} segundos.")
             raise ConnectionError("Timeout de autenticación SOAP. El servidor tardó demasiado en responder.")
         except requests.exceptions.RequestException as e:
             logging.error(f"Error de red o HTTP durante la autenticación: {e}. Respuesta: {response.text if response is not None else 'No hay respuesta'}")
@@ -151,7 +193,10 @@ class SoapClient:
             raise Exception("Error al procesar la respuesta de autenticación.")
 
 
-    def get_export_data_by_id(self, int_expgr_id: int, column_mapping: dict, final_columns: list, default_source_name: str) -> list:
+    def get_export_data_by_id(self, int_expgr_id: int, column_mapping: dict, final_columns: list, default_source_name: str,
+                              enrichment_report: dict = None) -> list:
+        # enrichment_report, si se pasa, recibe 'tn_incompleto': True cuando alguna orden de TiendaNube
+        # no se pudo consultar (circuito abierto o plazo agotado) y quedó con los datos de GlobalBluepoint
         MAX_RETRIES = 1 # Un reintento después del intento inicial
         successful_response = None # Para almacenar la respuesta exitosa
 
@@ -165,6 +210,11 @@ class SoapClient:
                 self.token = None # Asegurar que el token se invalide para forzar nueva autenticación
                 try:
                     self._authenticate()
+                except UpstreamUnavailableError:
+                    raise # Circuito abierto o plazo agotado: quien llama sirve datos en caché
+                except ConnectionError as e:
+                    logging.critical(f"¡ERROR CRÍTICO! Fallo al reautenticar durante el intento {attempt + 1}: {e}. No se puede proceder con la consulta.")
+                    raise UpstreamFailedError(str(e))
                 except Exception as e:
                     logging.critical(f"¡ERROR CRÍTICO! Fallo al reautenticar durante el intento {attempt + 1}: {e}. No se puede proceder con la consulta.")
                     return [] # Fallo crítico al autenticar, salimos
@@ -196,14 +246,16 @@ class SoapClient:
             )
 
             header_ws = {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": soap_action, "muteHttpExceptions": "true"}
-            REQUEST_TIMEOUT_SECONDS = 120
+            # El timeout lo decide el circuit breaker (latencia observada y plazo de la solicitud HTTP)
+            request_timeout_seconds = None
 
             logging.info(f"Intento {attempt + 1}/{MAX_RETRIES + 1}: Realizando consulta SOAP a wsExportDataById con intExpgr_id={int_expgr_id}...")
             logging.debug(f"Payload enviado para wsExportDataById: {xml_payload}")
 
             try:
-                response = requests.post(self.url_ws, data=xml_payload.encode('utf-8'), headers=header_ws, timeout=REQUEST_TIMEOUT_SECONDS)
-                response.raise_for_status()
+                with soap_breaker.guard('exportacion') as request_timeout_seconds:
+                    response = requests.post(self.url_ws, data=xml_payload.encode('utf-8'), headers=header_ws, timeout=request_timeout_seconds)
+                    response.raise_for_status()
 
                 # Analizar el contenido de la respuesta para detectar errores de token SOAP
                 if b"<soap:Fault>" in response.content:
@@ -228,13 +280,14 @@ class SoapClient:
                 break
 
             except requests.exceptions.Timeout:
-                logging.error(f"Intento {attempt + 1}: La solicitud para intExpgr_id={int_expgr_id} excedió el tiempo límite de {REQUEST_TIMEOUT_SECONDS} segundos.")
-                if attempt < MAX_RETRIES:
+                logging.error(f"Intento {attempt + 1}: La solicitud para intExpgr_id={int_expgr_id} excedió el tiempo límite de {request_timeout_seconds:.0f} segundos.")
+                if attempt < MAX_RETRIES and soap_breaker.has_time_for('exportacion'):
                     logging.info(f"Reintentando consulta SOAP por timeout...")
                     continue
                 else:
-                    logging.error(f"Todos los {MAX_RETRIES + 1} intentos de solicitud fallaron por timeout para intExpgr_id={int_expgr_id}.")
-                    return []
+                    # Sin reintentos, o sin plazo suficiente para un intento completo: mejor servir la caché ya
+                    logging.error(f"Consulta SOAP abandonada por timeout en el intento {attempt + 1} para intExpgr_id={int_expgr_id}.")
+                    raise UpstreamFailedError(f"El ERP no respondió a tiempo para intExpgr_id={int_expgr_id}.")
 
             except requests.exceptions.RequestException as e:
                 response_text = e.response.text if e.response is not None else 'No hay respuesta'
@@ -250,12 +303,12 @@ class SoapClient:
                         logging.error(f"Todos los {MAX_RETRIES + 1} intentos fallaron por error HTTP 401 para intExpgr_id={int_expgr_id}.")
                         return []
 
-                if attempt < MAX_RETRIES:
+                if attempt < MAX_RETRIES and soap_breaker.has_time_for('exportacion'):
                     logging.info(f"Reintentando consulta SOAP debido a error de red/HTTP no relacionado con autenticación directa...")
                     continue
                 else:
-                    logging.error(f"Todos los {MAX_RETRIES + 1} intentos de solicitud fallaron por error de red/HTTP para intExpgr_id={int_expgr_id}.")
-                    return []
+                    logging.error(f"Consulta SOAP abandonada por error de red/HTTP en el intento {attempt + 1} para intExpgr_id={int_expgr_id}.")
+                    raise UpstreamFailedError(f"Error de red/HTTP consultando el ERP para intExpgr_id={int_expgr_id}: {e}")
 
         if successful_response is None:
             logging.error(f"La solicitud a wsExportDataById para intExpgr_id={int_expgr_id} falló después de todos los intentos.")
@@ -341,6 +394,37 @@ class SoapClient:
             ]
             item_cols = ['item_id', 'EAN', 'Descripción', 'Cantidad']
 
+            # Todas las órdenes de TiendaNube de la exportación se resuelven juntas contra la tabla local
+            tn_orders_by_id = {}
+            use_tiendanube = EXPORT_CONFIGS[int_expgr_id].get('use_tiendanube', False)
+            if use_tiendanube and 'orderID' in df.columns:
+                tn_ids = set()
+                for raw_order_id in df['orderID'].dropna().unique():
+                    try:
+                        tn_ids.add(int(float(str(raw_order_id))))
+                    except (ValueError, TypeError):
+                        pass
+                tn_sync = get_tiendanube_sync()
+                tn_skipped = set()
+                if tn_sync:
+                    tn_orders_by_id, tn_skipped = tn_sync.get_orders(tn_ids)
+                elif get_tiendanube_client():
+                    # Sin tabla local (p. ej. backend/data no escribible): una consulta por orden, como antes
+                    logging.warning("Sincronización de TiendaNube no disponible. Consultando las órdenes una por una.")
+                    for tn_id in tn_ids:
+                        try:
+                            tn_order_details = get_tiendanube_client().get_order_details(tn_id)
+                        except UpstreamUnavailableError as e:
+                            logging.warning(f"TiendaNube no consultado para la orden {tn_id}: {e}")
+                            tn_skipped.add(tn_id)
+                            continue
+                        if tn_order_details:
+                            tn_orders_by_id[tn_id] = tn_order_details
+                if tn_skipped:
+                    logging.warning(f"{len(tn_skipped)} orden(es) de TiendaNube sin consultar para intExpgr_id={int_expgr_id}; se usan los datos de GlobalBluepoint.")
+                    if enrichment_report is not None:
+                        enrichment_report['tn_incompleto'] = True
+
             for pedido_id, group in df.groupby('IDPedido'):
                 order_header = {}
 
@@ -369,12 +453,10 @@ class SoapClient:
                         logging.warning(f"orderID '{order_header['orderID']}' de GlobalBluepoint no es un número válido para TiendaNube. Saltando consulta TN. Error: {ve}")
                         tiendanube_order_id = None
 
-                use_tiendanube = EXPORT_CONFIGS[int_expgr_id].get('use_tiendanube', False)
-
                 tn_order_details = None
-                if use_tiendanube and tiendanube_order_id and tiendanube_client:
-                    tn_order_details = tiendanube_client.get_order_details(tiendanube_order_id)
-                    
+                if use_tiendanube and tiendanube_order_id:
+                    tn_order_details = tn_orders_by_id.get(tiendanube_order_id)
+
                 if isinstance(tn_order_details, dict) and tn_order_details and 'shipping_address' in tn_order_details:
                     shipping_address = tn_order_details['shipping_address']
                     logging.info(f"Datos de envío de TiendaNube obtenidos para orden {tiendanube_order_id}.")
@@ -560,49 +642,180 @@ EXPORT_CONFIGS = {
     },
 }
 
+# Los clientes se construyen recién cuando se usan: con gunicorn --preload este módulo se importa
+# en el master antes del fork, y ni los sockets ni los hilos sobreviven al fork.
 soap_client = None
+_soap_client_lock = threading.Lock()
 
 def get_soap_client():
     global soap_client
     if soap_client is None:
-        try:
-            soap_client = SoapClient(URL_WS, P_USERNAME, P_PASSWORD, P_COMPANY, P_WEBWSERVICE)
-            logging.info("SoapClient reinicializado con éxito.")
-        except Exception as e:
-            logging.error(f"No se pudo reinicializar SoapClient dinámicamente: {e}", exc_info=True)
-            soap_client = None
+        # El lock evita que el calentamiento y la primera solicitud autentiquen dos veces
+        with _soap_client_lock:
+            if soap_client is None:
+                try:
+                    soap_client = SoapClient(URL_WS, P_USERNAME, P_PASSWORD, P_COMPANY, P_WEBWSERVICE)
+                    logging.info("SoapClient reinicializado con éxito.")
+                except UpstreamUnavailableError:
+                    raise
+                except Exception as e:
+                    logging.error(f"No se pudo reinicializar SoapClient dinámicamente: {e}", exc_info=True)
+                    soap_client = None
     return soap_client
 
 
 tiendanube_client = None
-try:
-    tiendanube_client = TiendaNubeClient(
-        TIENDANUBE_STORE_ID,
-        TIENDANUBE_ACCESS_TOKEN,
-        TIENDANUBE_BASE_API_URL,
-        TIENDANUBE_USER_AGENT
-    )
-    logging.info("Cliente TiendaNube inicializado.")
-    print(f"DEBUG: tiendanube_client se inicializó como: {tiendanube_client}")
-except Exception as e:
-    logging.critical(f"¡ERROR CRÍTICO! No se pudo inicializar el cliente TiendaNube al inicio: {e}", exc_info=True)
-    print(f"DEBUG: Fallo al inicializar tiendanube_client: {e}")
+_tiendanube_client_lock = threading.Lock()
 
-def process_data_for_export(int_expgr_id):
+def get_tiendanube_client():
+    global tiendanube_client
+    if tiendanube_client is None:
+        with _tiendanube_client_lock:
+            if tiendanube_client is None:
+                try:
+                    tiendanube_client = TiendaNubeClient(
+                        TIENDANUBE_STORE_ID,
+                        TIENDANUBE_ACCESS_TOKEN,
+                        TIENDANUBE_BASE_API_URL,
+                        TIENDANUBE_USER_AGENT
+                    )
+                except Exception as e:
+                    logging.critical(f"¡ERROR CRÍTICO! No se pudo inicializar el cliente TiendaNube: {e}", exc_info=True)
+    return tiendanube_client
+
+
+def warm_up_clients():
+    # Se llama en cada worker después del fork (ver gunicorn_conf.py): autentica SOAP y arranca
+    # la sincronización de TiendaNube sin bloquear al worker
+    def worker():
+        try:
+            get_soap_client()
+        except UpstreamUnavailableError as e:
+            logging.warning(f"No se calentó el cliente SOAP: {e}")
+        get_tiendanube_sync()
+
+    threading.Thread(target=worker, name="warm-up-clients", daemon=True).start()
+
+def _fetch_export(int_expgr_id):
         client = get_soap_client()
         if not client:
-            raise RuntimeError("Cliente SOAP no disponible.")
-        processed_orders_list = soap_client.get_export_data_by_id(
+            raise UpstreamFailedError("Cliente SOAP no disponible.")
+        enrichment_report = {}
+        processed_orders_list = client.get_export_data_by_id(
         int_expgr_id=int_expgr_id,
         column_mapping=EXPORT_CONFIGS[int_expgr_id]['column_mapping'],
         final_columns=EXPORT_CONFIGS[int_expgr_id]['final_columns'],
-        default_source_name=EXPORT_CONFIGS[int_expgr_id]['source_name']
+        default_source_name=EXPORT_CONFIGS[int_expgr_id]['source_name'],
+        enrichment_report=enrichment_report
     )
 
+        if processed_orders_list:
+            fetched_at = time.time()
+            # Con órdenes de TiendaNube sin consultar la exportación está degradada: se sirve marcada como
+            # desactualizada y no se persiste, para no pisar un snapshot completo con direcciones de respaldo
+            tn_incomplete = enrichment_report.get('tn_incompleto', False)
+            export_cache[int_expgr_id] = {'orders': processed_orders_list, 'fetched_at': fetched_at, 'from_snapshot': False, 'stale': tn_incomplete}
+            store = get_snapshot_store()
+            if tn_incomplete:
+                logging.warning(f"Exportación {int_expgr_id} con datos de TiendaNube incompletos: no se guarda el snapshot.")
+            elif store:
+                try:
+                    store.save(int_expgr_id, processed_orders_list, fetched_at)
+                except Exception as e:
+                    logging.error(f"No se pudo guardar el snapshot de export_id {int_expgr_id}: {e}", exc_info=True)
+
     # ¡IMPORTANTE! Debe devolver la lista completa, no solo el primer elemento.
     # Elimina cualquier '[0]' al final de esta línea de retorno si lo ves.
         return processed_orders_list
 
+# Última exportación procesada en este worker: {export_id: {'orders', 'fetched_at', 'from_snapshot', 'stale'}}
+export_cache = {}
+_refreshing_exports = set()
+_refreshing_lock = threading.Lock()
+
+def _refresh_export_in_background(int_expgr_id):
+    with _refreshing_lock:
+        if int_expgr_id in _refreshing_exports:
+            return
+        _refreshing_exports.add(int_expgr_id)
+
+    def worker():
+        try:
+            logging.info(f"Refrescando export_id {int_expgr_id} en segundo plano...")
+            _fetch_export(int_expgr_id)
+        except UpstreamUnavailableError as e:
+            logging.warning(f"Refresco en segundo plano de export_id {int_expgr_id} omitido: {e}")
+        except Exception as e:
+            logging.error(f"Fallo el refresco en segundo plano de export_id {int_expgr_id}: {e}", exc_info=True)
+        finally:
+            with _refreshing_lock:
+                _refreshing_exports.discard(int_expgr_id)
+
+    threading.Thread(target=worker, name=f"refresh-export-{int_expgr_id}", daemon=True).start()
+
+def get_export_cache_info(int_expgr_id):
+    cached = export_cache.get(int_expgr_id)
+    if cached is None:
+        return None
+    return {
+        'fetched_at': cached['fetched_at'],
+        'from_snapshot': cached['from_snapshot'],
+        'stale': cached.get('stale', False),
+        'refreshing': int_expgr_id in _refreshing_exports,
+    }
+
+tiendanube_sync = None
+_tiendanube_sync_lock = threading.Lock()
+
+def get_tiendanube_sync():
+    global tiendanube_sync
+    if tiendanube_sync is None and get_tiendanube_client():
+        with _tiendanube_sync_lock:
+            if tiendanube_sync is None:
+                try:
+                    tiendanube_sync = TiendaNubeSync(get_tiendanube_client())
+                    tiendanube_sync.start()
+                except Exception as e:
+                    logging.error(f"No se pudo inicializar la sincronización de TiendaNube: {e}", exc_info=True)
+    return tiendanube_sync
+
+def process_data_for_export(int_expgr_id):
+    # Worker recién iniciado: servir el último snapshot persistido y traer la exportación fresca en segundo plano
+    old_snapshot = None
+    if int_expgr_id not in export_cache:
+        store = get_snapshot_store()
+        snapshot = store.load_latest(int_expgr_id) if store else None
+        if snapshot and snapshot['orders'] and time.time() - snapshot['fetched_at'] > SNAPSHOT_MAX_AGE_SECONDS:
+            # Demasiado viejo para servirlo como respuesta normal; sólo se usa si el ERP no responde
+            logging.info(f"Snapshot {snapshot['id']} de export_id {int_expgr_id} supera {SNAPSHOT_MAX_AGE_SECONDS} segundos. Consultando en vivo.")
+            old_snapshot = snapshot
+        elif snapshot and snapshot['orders']:
+            logging.info(f"Sirviendo snapshot {snapshot['id']} de export_id {int_expgr_id} mientras se refresca la exportación.")
+            export_cache[int_expgr_id] = {'orders': snapshot['orders'], 'fetched_at': snapshot['fetched_at'], 'from_snapshot': True, 'stale': False}
+            _refresh_export_in_background(int_expgr_id)
+            return snapshot['orders']
+
+    # Si ya hay un refresco en curso no se lanza una segunda consulta SOAP
+    if int_expgr_id in _refreshing_exports and int_expgr_id in export_cache:
+        return export_cache[int_expgr_id]['orders']
+
+    # ERP caído (circuito abierto): se responde al instante con lo último conocido
+    if soap_breaker.is_open() and int_expgr_id in export_cache:
+        logging.warning(f"Circuito SOAP abierto: sirviendo datos en caché para export_id {int_expgr_id}.")
+        export_cache[int_expgr_id]['stale'] = True
+        return export_cache[int_expgr_id]['orders']
+
+    try:
+        return _fetch_export(int_expgr_id)
+    except UpstreamUnavailableError as e:
+        if int_expgr_id not in export_cache and old_snapshot:
+            export_cache[int_expgr_id] = {'orders': old_snapshot['orders'], 'fetched_at': old_snapshot['fetched_at'], 'from_snapshot': True, 'stale': True}
+        if int_expgr_id not in export_cache:
+            raise
+        logging.warning(f"{e} Sirviendo datos en caché para export_id {int_expgr_id}.")
+        export_cache[int_expgr_id]['stale'] = True
+        return export_cache[int_expgr_id]['orders']
+
 def generate_shipping_label_zpl(order_data, total_bultos=1, manual_tipo_envio_etiqueta=None, manual_tipo_domicilio=None):
     zpl_templates_path = 'templates/etiqueta.zpl'
 
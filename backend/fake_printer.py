@@ -0,0 +1,54 @@
+"""Impresora Zebra falsa para probar la cola de impresión sin hardware.
+
+Escucha en un puerto TCP (por defecto 9100), acepta conexiones como lo haría
+la impresora y cuenta las etiquetas recibidas (cada ^XA ... ^XZ).
+
+Uso:
+    python -m backend.fake_printer --port 9100
+    ZEBRA_PRINTERS="prueba=127.0.0.1:9100" gunicorn ... "backend.app:app"
+"""
+import argparse
+import logging
+import socketserver
+import threading
+
+
+class FakePrinterHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        chunks = []
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+        payload = b''.join(chunks).decode('utf-8', errors='replace')
+        labels = payload.count('^XA')
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.labels_received += labels
+            self.server.payloads.append(payload)
+        logging.info(f"Conexión desde {self.client_address[0]}: {labels} etiqueta(s), {len(payload)} bytes. Total: {self.server.labels_received}.")
+
+
+class FakePrinterServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, FakePrinterHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.labels_received = 0
+        self.payloads = []
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    arg_parser = argparse.ArgumentParser(description="Impresora Zebra falsa (raw TCP).")
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=9100)
+    args = arg_parser.parse_args()
+
+    with FakePrinterServer((args.host, args.port)) as server:
+        logging.info(f"Impresora falsa escuchando en {args.host}:{args.port}")
+        server.serve_forever()
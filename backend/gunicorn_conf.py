@@ -0,0 +1,23 @@
+# Configuración de Gunicorn (se usa desde gunicorn_start.sh con -c)
+#
+# Con preload_app la aplicación (Flask, pandas, lxml, ...) se importa una sola vez en el master
+# y los workers la comparten copy-on-write. Los clientes SOAP/TiendaNube, los hilos y las
+# conexiones SQLite se crean recién en cada worker, después del fork.
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+preload_app = True
+
+# El worker no puede morir antes de que venza el plazo de la solicitud (REQUEST_DEADLINE_SECONDS,
+# mismo valor por defecto que en circuit_breaker.py): las llamadas al ERP se cortan en ese plazo y
+# queda un margen para servir los datos en caché y serializar la respuesta.
+timeout = int(float(os.getenv("REQUEST_DEADLINE_SECONDS", "150"))) + 30
+
+
+def post_fork(server, worker):
+    from backend.data_processor import warm_up_clients
+    warm_up_clients()
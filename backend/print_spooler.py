@@ -0,0 +1,306 @@
+import fcntl
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+from backend.snapshot_store import SNAPSHOT_DB_PATH
+
+load_dotenv()
+
+# Impresoras Zebra de red, formato: "nombre=host[:puerto],nombre2=host2[:puerto]"
+# Si no se indica puerto se usa el 9100 (raw TCP).
+ZEBRA_PRINTERS = os.getenv("ZEBRA_PRINTERS", "")
+ZEBRA_DEFAULT_PORT = 9100
+ZEBRA_SOCKET_TIMEOUT = float(os.getenv("ZEBRA_SOCKET_TIMEOUT", "10"))
+ZEBRA_MAX_RETRIES = int(os.getenv("ZEBRA_MAX_RETRIES", "3"))
+ZEBRA_MAX_BATCH_LABELS = int(os.getenv("ZEBRA_MAX_BATCH_LABELS", "50"))
+# La cola vive en el mismo SQLite que los snapshots para que todos los workers de gunicorn la compartan
+PRINT_SPOOLER_DB_PATH = os.getenv("PRINT_SPOOLER_DB_PATH", SNAPSHOT_DB_PATH)
+# Cada cuánto revisa la cola el proceso que imprime
+PRINT_POLL_SECONDS = 0.5
+
+# Estados posibles de un trabajo de impresión
+JOB_EN_COLA = "en_cola"
+JOB_IMPRIMIENDO = "imprimiendo"
+JOB_IMPRESO = "impreso"
+JOB_ERROR = "error"
+
+# Cuántos trabajos terminados se conservan para consultar su estado
+MAX_FINISHED_JOBS = 500
+
+# Separador entre etiquetas dentro de la columna labels
+_LABEL_SEPARATOR = "\x1e"
+
+
+def parse_printers_config(raw_config: str) -> dict:
+    printers = {}
+    for entry in filter(None, (part.strip() for part in raw_config.split(','))):
+        if '=' not in entry:
+            logging.warning(f"Entrada de impresora inválida en ZEBRA_PRINTERS: '{entry}'. Se esperaba nombre=host[:puerto].")
+            continue
+        name, address = (x.strip() for x in entry.split('=', 1))
+        host, _, port = address.partition(':')
+        try:
+            printers[name] = (host, int(port) if port else ZEBRA_DEFAULT_PORT)
+        except ValueError:
+            logging.warning(f"Puerto inválido para la impresora '{name}': '{port}'.")
+    return printers
+
+
+class PrintJobStore:
+    """Cola de trabajos de impresión en SQLite, compartida por todos los workers de gunicorn."""
+
+    def __init__(self, path: str = PRINT_SPOOLER_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS print_jobs ("
+                " id TEXT PRIMARY KEY,"
+                " seq INTEGER NOT NULL,"
+                " printer TEXT NOT NULL,"
+                " descripcion TEXT,"
+                " labels TEXT NOT NULL,"
+                " label_count INTEGER NOT NULL,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " error TEXT,"
+                " batch_id TEXT,"
+                " created_at REAL NOT NULL,"
+                " finished_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_print_jobs_queue ON print_jobs (printer, status, seq)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, printer_name: str, labels: list, descripcion: str = "") -> dict:
+        job_id = uuid.uuid4().hex
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO print_jobs (id, seq, printer, descripcion, labels, label_count, status, created_at) "
+                "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM print_jobs), ?, ?, ?, ?, ?, ?)",
+                (job_id, printer_name, descripcion, _LABEL_SEPARATOR.join(labels), len(labels), JOB_EN_COLA, time.time())
+            )
+            conn.execute(
+                "DELETE FROM print_jobs WHERE status IN (?, ?) AND id NOT IN "
+                "(SELECT id FROM print_jobs WHERE status IN (?, ?) ORDER BY seq DESC LIMIT ?)",
+                (JOB_IMPRESO, JOB_ERROR, JOB_IMPRESO, JOB_ERROR, MAX_FINISHED_JOBS)
+            )
+        return self.get(job_id)
+
+    def get(self, job_id: str):
+        row = self._connection().execute(
+            "SELECT id, printer, descripcion, label_count, status, attempts, error, created_at, finished_at "
+            "FROM print_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row[0], 'impresora': row[1], 'descripcion': row[2], 'etiquetas': row[3], 'estado': row[4],
+            'intentos': row[5], 'error': row[6], 'creado': row[7], 'finalizado': row[8],
+        }
+
+    def take_batch(self, printer_name: str, max_labels: int) -> list:
+        # Toma los trabajos en cola de la impresora (en orden) hasta completar max_labels etiquetas
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT id, labels, label_count FROM print_jobs WHERE printer = ? AND status = ? ORDER BY seq",
+                (printer_name, JOB_EN_COLA)
+            ).fetchall()
+            batch = []
+            label_count = 0
+            for job_id, labels, count in rows:
+                if batch and label_count + count > max_labels:
+                    break
+                batch.append((job_id, labels.split(_LABEL_SEPARATOR)))
+                label_count += count
+            if batch:
+                conn.executemany("UPDATE print_jobs SET status = ? WHERE id = ?", [(JOB_IMPRIMIENDO, job_id) for job_id, _ in batch])
+        return batch
+
+    def set_attempts(self, job_ids: list, attempts: int):
+        with self._connection() as conn:
+            conn.executemany("UPDATE print_jobs SET attempts = ? WHERE id = ?", [(attempts, job_id) for job_id in job_ids])
+
+    def finish(self, job_ids: list, status: str, batch_id: str = None, error: str = None):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany(
+                "UPDATE print_jobs SET status = ?, batch_id = ?, error = ?, finished_at = ? WHERE id = ?",
+                [(status, batch_id, error, now, job_id) for job_id in job_ids]
+            )
+
+    def fail_interrupted(self):
+        # Trabajos que quedaron a medio enviar porque murió el proceso que imprimía: no se reenvían
+        # automáticamente para no duplicar etiquetas
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE print_jobs SET status = ?, error = ?, finished_at = ? WHERE status = ?",
+                (JOB_ERROR, "Envío interrumpido al reiniciarse el proceso de impresión.", time.time(), JOB_IMPRIMIENDO)
+            )
+
+    def printer_stats(self, printer_name: str, window_seconds: int = 60) -> dict:
+        conn = self._connection()
+        queued, printed, batches, recent = conn.execute(
+            "SELECT SUM(status = ?), SUM(CASE WHEN status = ? THEN label_count ELSE 0 END), "
+            "COUNT(DISTINCT CASE WHEN status = ? THEN batch_id END), "
+            "SUM(CASE WHEN status = ? AND finished_at >= ? THEN label_count ELSE 0 END) "
+            "FROM print_jobs WHERE printer = ?",
+            (JOB_EN_COLA, JOB_IMPRESO, JOB_IMPRESO, JOB_IMPRESO, time.time() - window_seconds, printer_name)
+        ).fetchone()
+        last_error = conn.execute(
+            "SELECT error FROM print_jobs WHERE printer = ? AND status = ? ORDER BY seq DESC LIMIT 1",
+            (printer_name, JOB_ERROR)
+        ).fetchone()
+        return {
+            'en_cola': queued or 0,
+            'etiquetas_impresas': printed or 0,
+            'lotes_enviados': batches or 0,
+            'etiquetas_por_minuto': round((recent or 0) * 60.0 / window_seconds, 2),
+            'ultimo_error': last_error[0] if last_error else None,
+        }
+
+    def count_by_status(self, status: str) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM print_jobs WHERE status = ?", (status,)).fetchone()[0]
+
+
+class PrinterWorker(threading.Thread):
+    """Envía a una única impresora los trabajos de su cola.
+
+    Los trabajos consecutivos que ya están esperando en la cola se agrupan y se
+    mandan por la misma conexión TCP para no abrir un socket por etiqueta.
+    """
+
+    def __init__(self, store: PrintJobStore, name: str, host: str, port: int, timeout: float = ZEBRA_SOCKET_TIMEOUT,
+                 max_retries: int = ZEBRA_MAX_RETRIES, max_batch_labels: int = ZEBRA_MAX_BATCH_LABELS,
+                 retry_backoff_seconds: float = 1.0, poll_seconds: float = PRINT_POLL_SECONDS):
+        super().__init__(name=f"zebra-{name}", daemon=True)
+        self.store = store
+        self.printer_name = name
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_batch_labels = max_batch_labels
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.poll_seconds = poll_seconds
+
+    def run(self):
+        while True:
+            try:
+                batch = self.store.take_batch(self.printer_name, self.max_batch_labels)
+                if batch:
+                    self._print_batch(batch)
+                else:
+                    time.sleep(self.poll_seconds)
+            except Exception as e:
+                logging.error(f"Error inesperado en el worker de la impresora '{self.printer_name}': {e}", exc_info=True)
+                time.sleep(self.poll_seconds)
+
+    def _print_batch(self, batch: list):
+        job_ids = [job_id for job_id, _ in batch]
+        payload = "\n".join(label for _, labels in batch for label in labels).encode('utf-8')
+        label_count = sum(len(labels) for _, labels in batch)
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            self.store.set_attempts(job_ids, attempt + 1)
+            try:
+                with socket.create_connection((self.host, self.port), timeout=self.timeout) as conn:
+                    conn.sendall(payload)
+                logging.info(f"Impresora '{self.printer_name}': enviadas {label_count} etiquetas en {len(batch)} trabajo(s) (intento {attempt + 1}).")
+                self.store.finish(job_ids, JOB_IMPRESO, batch_id=uuid.uuid4().hex)
+                return
+            except OSError as e:
+                last_error = str(e)
+                logging.warning(f"Impresora '{self.printer_name}' ({self.host}:{self.port}): fallo al enviar etiquetas en el intento {attempt + 1}/{self.max_retries + 1}: {e}")
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_backoff_seconds * (2 ** attempt))
+
+        logging.error(f"Impresora '{self.printer_name}': se agotaron los reintentos para {len(batch)} trabajo(s).")
+        self.store.finish(job_ids, JOB_ERROR, error=last_error)
+
+
+class PrintSpooler:
+    """Cola de impresión compartida entre los workers de gunicorn.
+
+    Cualquier proceso puede encolar trabajos y consultar su estado. Sólo el
+    proceso que tiene el lock de archivo arranca los PrinterWorker, así cada
+    impresora recibe conexiones de un único proceso. Si ese proceso muere, el
+    lock se libera y otro worker toma su lugar.
+    """
+
+    def __init__(self, printers: dict, path: str = PRINT_SPOOLER_DB_PATH, **worker_options):
+        self.printers = printers
+        self.store = PrintJobStore(path)
+        self.lock_path = f"{path}.print.lock"
+        self.worker_options = worker_options
+        self.workers = {}
+        threading.Thread(target=self._acquire_and_run, name="print-spooler-lock", daemon=True).start()
+
+    def _acquire_and_run(self):
+        try:
+            lock_file = open(self.lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # bloquea hasta que ningún otro proceso imprima
+            self._lock_file = lock_file
+            self.store.fail_interrupted()
+        except Exception as e:
+            logging.critical(f"¡ERROR CRÍTICO! No se pudo tomar el lock de impresión {self.lock_path}: {e}. Este proceso no enviará trabajos a las impresoras.", exc_info=True)
+            return
+        for name, (host, port) in self.printers.items():
+            worker = PrinterWorker(self.store, name, host, port, **self.worker_options)
+            worker.start()
+            self.workers[name] = worker
+            logging.info(f"Worker de impresión iniciado para '{name}' en {host}:{port} (pid {os.getpid()}).")
+
+    def submit(self, printer_name: str, labels: list, descripcion: str = "") -> dict:
+        if printer_name not in self.printers:
+            raise KeyError(f"Impresora '{printer_name}' no configurada.")
+        return self.store.add(printer_name, labels, descripcion)
+
+    def get_job(self, job_id: str):
+        return self.store.get(job_id)
+
+    def status(self) -> dict:
+        printers = []
+        for name, (host, port) in self.printers.items():
+            stats = self.store.printer_stats(name)
+            printers.append({'impresora': name, 'host': host, 'puerto': port, **stats})
+        return {
+            'impresoras': printers,
+            'trabajos_en_cola': self.store.count_by_status(JOB_EN_COLA),
+            'trabajos_con_error': self.store.count_by_status(JOB_ERROR),
+            'etiquetas_por_minuto': round(sum(p['etiquetas_por_minuto'] for p in printers), 2),
+        }
+
+
+print_spooler = None
+_print_spooler_lock = threading.Lock()
+
+def get_print_spooler():
+    global print_spooler
+    if print_spooler is None:
+        with _print_spooler_lock:
+            if print_spooler is None:
+                printers = parse_printers_config(ZEBRA_PRINTERS)
+                if not printers:
+                    logging.warning("No hay impresoras configuradas en ZEBRA_PRINTERS. La cola de impresión queda vacía.")
+                try:
+                    print_spooler = PrintSpooler(printers)
+                except Exception as e:
+                    logging.error(f"No se pudo abrir la cola de impresión en {PRINT_SPOOLER_DB_PATH}: {e}", exc_info=True)
+    return print_spooler
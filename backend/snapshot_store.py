@@ -0,0 +1,150 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dotenv import load_dotenv
+from werkzeug.http import http_date
+
+load_dotenv()
+
+SNAPSHOT_DB_PATH = os.getenv("SNAPSHOT_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "snapshots.sqlite3"))
+# Cuántos snapshots se conservan por export_id para poder comparar exportaciones
+SNAPSHOT_HISTORY = int(os.getenv("SNAPSHOT_HISTORY", "20"))
+# Un snapshot más viejo que esto no se sirve como respuesta principal al arrancar un worker
+SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", "1800"))
+# Tamaño máximo del mapeo en memoria de SQLite (bytes)
+SNAPSHOT_MMAP_SIZE = 64 * 1024 * 1024
+
+
+def _json_default(value):
+    # Las fechas del DataFrame llegan como pd.Timestamp (subclase de datetime) y los enteros pueden ser de numpy.
+    # Las fechas se guardan igual que las emite jsonify (fecha HTTP en GMT) para que el frontend vea lo mismo
+    # venga la respuesta de un snapshot o de la consulta en vivo.
+    if isinstance(value, datetime.date):
+        return http_date(value)
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class SnapshotStore:
+    """Guarda en SQLite la última lista de pedidos procesada de cada exportación.
+
+    Cada snapshot es la lista ya enriquecida (cabecera, ítems y datos de TiendaNube)
+    serializada en JSON y comprimida con zlib, junto con el momento en que se obtuvo.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_DB_PATH, history: int = SNAPSHOT_HISTORY):
+        self.path = path
+        self.history = history
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " export_id INTEGER NOT NULL,"
+                " fetched_at REAL NOT NULL,"
+                " order_count INTEGER NOT NULL,"
+                " payload BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_export ON snapshots (export_id, id)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # Una conexión por hilo: los refrescos en segundo plano corren en sus propios hilos
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")  # varios workers de gunicorn leen y escriben a la vez
+            conn.execute(f"PRAGMA mmap_size={SNAPSHOT_MMAP_SIZE}")
+            self._local.conn = conn
+        return conn
+
+    def save(self, export_id: int, orders: list, fetched_at: float = None) -> int:
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        payload = zlib.compress(json.dumps(orders, default=_json_default, ensure_ascii=False).encode('utf-8'))
+        with self._connection() as conn:
+            # Si la exportación no cambió (p. ej. varias descargas de etiquetas seguidas) sólo se actualiza
+            # fetched_at del último snapshot, así el historial guarda exportaciones distintas
+            latest = conn.execute(
+                "SELECT id, payload FROM snapshots WHERE export_id = ? ORDER BY id DESC LIMIT 1",
+                (export_id,)
+            ).fetchone()
+            if latest and latest[1] == payload:
+                conn.execute("UPDATE snapshots SET fetched_at = ? WHERE id = ?", (fetched_at, latest[0]))
+                logging.info(f"Snapshot {latest[0]} de export_id {export_id} sin cambios; se actualizó su fecha de obtención.")
+                return latest[0]
+            cursor = conn.execute(
+                "INSERT INTO snapshots (export_id, fetched_at, order_count, payload) VALUES (?, ?, ?, ?)",
+                (export_id, fetched_at, len(orders), payload)
+            )
+            conn.execute(
+                "DELETE FROM snapshots WHERE export_id = ? AND id NOT IN "
+                "(SELECT id FROM snapshots WHERE export_id = ? ORDER BY id DESC LIMIT ?)",
+                (export_id, export_id, self.history)
+            )
+        logging.info(f"Snapshot {cursor.lastrowid} guardado para export_id {export_id} con {len(orders)} pedidos ({len(payload)} bytes).")
+        return cursor.lastrowid
+
+    def load_latest(self, export_id: int):
+        row = self._connection().execute(
+            "SELECT id, fetched_at, payload FROM snapshots WHERE export_id = ? ORDER BY id DESC LIMIT 1",
+            (export_id,)
+        ).fetchone()
+        return self._decode(row)
+
+    def load(self, export_id: int, snapshot_id: int):
+        row = self._connection().execute(
+            "SELECT id, fetched_at, payload FROM snapshots WHERE export_id = ? AND id = ?",
+            (export_id, snapshot_id)
+        ).fetchone()
+        return self._decode(row)
+
+    def list_snapshots(self, export_id: int) -> list:
+        rows = self._connection().execute(
+            "SELECT id, fetched_at, order_count FROM snapshots WHERE export_id = ? ORDER BY id DESC",
+            (export_id,)
+        ).fetchall()
+        return [{'id': r[0], 'fetched_at': r[1], 'pedidos': r[2]} for r in rows]
+
+    @staticmethod
+    def _decode(row):
+        if row is None:
+            return None
+        snapshot_id, fetched_at, payload = row
+        return {'id': snapshot_id, 'fetched_at': fetched_at, 'orders': json.loads(zlib.decompress(payload))}
+
+
+def compare_snapshots(old_orders: list, new_orders: list) -> dict:
+    old_by_id = {order.get('IDPedido'): order for order in old_orders}
+    new_by_id = {order.get('IDPedido'): order for order in new_orders}
+    return {
+        'nuevos': sorted(set(new_by_id) - set(old_by_id)),
+        'eliminados': sorted(set(old_by_id) - set(new_by_id)),
+        'modificados': sorted(
+            pedido_id for pedido_id in set(old_by_id) & set(new_by_id)
+            if json.dumps(old_by_id[pedido_id], default=_json_default, sort_keys=True)
+            != json.dumps(new_by_id[pedido_id], default=_json_default, sort_keys=True)
+        ),
+    }
+
+
+snapshot_store = None
+_snapshot_store_lock = threading.Lock()
+
+def get_snapshot_store():
+    global snapshot_store
+    if snapshot_store is None:
+        with _snapshot_store_lock:
+            if snapshot_store is None:
+                try:
+                    snapshot_store = SnapshotStore()
+                except Exception as e:
+                    logging.error(f"No se pudo abrir el almacén de snapshots en {SNAPSHOT_DB_PATH}: {e}", exc_info=True)
+    return snapshot_store
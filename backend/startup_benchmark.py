@@ -0,0 +1,135 @@
+"""Benchmark de arranque de la aplicación bajo Gunicorn.
+
+Modos:
+  - normal:  gunicorn sin --preload,
+  - preload: sólo agrega --preload (aísla el efecto del preload),
+  - config:  con backend/gunicorn_conf.py, como en producción (preload + calentamiento post_fork).
+
+Mide, para cada modo:
+  - tiempo de importación de backend.app en un proceso limpio,
+  - RSS y PSS de cada worker (PSS reparte las páginas compartidas copy-on-write),
+  - tiempo hasta la primera respuesta exitosa de la ruta indicada.
+
+Uso (desde la raíz del proyecto, con el entorno virtual activo):
+    python -m backend.startup_benchmark --ruta /api/pedidos/80 --workers 3
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GUNICORN_CONF = os.path.join(PROJECT_ROOT, 'backend', 'gunicorn_conf.py')
+MODES = ['normal', 'preload', 'config']
+
+
+def measure_import_time() -> float:
+    code = "import time; t = time.perf_counter(); import backend.app; print(time.perf_counter() - t)"
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=PROJECT_ROOT, stderr=subprocess.DEVNULL)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def child_pids(parent_pid: int) -> list:
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # El nombre del proceso va entre paréntesis y puede tener espacios
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[1]) == parent_pid:
+                pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def memory_kb(pid: int) -> dict:
+    result = {'rss_kb': None, 'pss_kb': None}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'Rss':
+                    result['rss_kb'] = int(value.split()[0])
+                elif key == 'Pss':
+                    result['pss_kb'] = int(value.split()[0])
+    except OSError:
+        pass
+    return result
+
+
+def wait_for_response(url: str, timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.1)
+    return None
+
+
+def run_mode(mode: str, args) -> dict:
+    command = [
+        sys.executable, '-m', 'gunicorn',
+        '--workers', str(args.workers),
+        '--bind', f'127.0.0.1:{args.port}',
+        # Explícito en todos los modos: con el default de gunicorn (30 s) una exportación lenta mata al worker
+        '--timeout', str(args.worker_timeout),
+    ]
+    if mode == 'preload':
+        command.append('--preload')
+    elif mode == 'config':
+        command += ['-c', GUNICORN_CONF]
+    command.append('backend.app:app')
+
+    master = subprocess.Popen(command, cwd=PROJECT_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_response = wait_for_response(f'http://127.0.0.1:{args.port}{args.ruta}', args.timeout)
+        # Dar tiempo a que todos los workers terminen de arrancar antes de medir memoria
+        time.sleep(1)
+        workers = [memory_kb(pid) for pid in child_pids(master.pid)]
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait(timeout=30)
+
+    return {
+        'modo': mode,
+        'primera_respuesta_s': first_response,
+        'workers': workers,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark de arranque de Gunicorn.")
+    arg_parser.add_argument('--ruta', default='/', help="Ruta a consultar hasta obtener un 200.")
+    arg_parser.add_argument('--workers', type=int, default=3)
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--timeout', type=float, default=300)
+    arg_parser.add_argument('--worker-timeout', type=int, default=180,
+                            help="--timeout de gunicorn; por defecto el mismo que fija gunicorn_conf.py.")
+    arg_parser.add_argument('--modo', choices=MODES + ['todos'], default='todos')
+    args = arg_parser.parse_args()
+
+    print(f"Importación de backend.app: {measure_import_time():.2f} s")
+
+    modes = MODES if args.modo == 'todos' else [args.modo]
+    for mode in modes:
+        result = run_mode(mode, args)
+        first_response = result['primera_respuesta_s']
+        print(f"\n[{result['modo']}] primera respuesta exitosa de {args.ruta}: "
+              f"{f'{first_response:.2f} s' if first_response is not None else 'sin respuesta'}")
+        for i, worker in enumerate(result['workers'], 1):
+            print(f"  worker {i}: RSS {worker['rss_kb']} kB, PSS {worker['pss_kb']} kB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+from backend.circuit_breaker import UpstreamUnavailableError
+from backend.snapshot_store import SNAPSHOT_DB_PATH
+
+load_dotenv()
+
+TN_SYNC_DB_PATH = os.getenv("TN_SYNC_DB_PATH", SNAPSHOT_DB_PATH)
+# Cada cuántos segundos se piden a TiendaNube las órdenes modificadas
+TN_SYNC_INTERVAL_SECONDS = int(os.getenv("TN_SYNC_INTERVAL_SECONDS", "120"))
+# En la primera sincronización se traen las órdenes modificadas en los últimos N días
+TN_SYNC_INITIAL_DAYS = int(os.getenv("TN_SYNC_INITIAL_DAYS", "30"))
+TN_SYNC_PAGE_SIZE = 200  # máximo que acepta la API de TiendaNube
+# Solapamiento entre sincronizaciones para no perder órdenes modificadas durante la anterior
+TN_SYNC_OVERLAP_SECONDS = 60
+
+
+class TiendaNubeSync:
+    """Mantiene una tabla local con la dirección de envío de las órdenes de TiendaNube.
+
+    En lugar de un GET por orden en cada refresco, recorre el listado de órdenes
+    filtrado por updated_at_min y guarda sólo lo que usa la etiqueta. El
+    enriquecimiento de una exportación pasa a ser una consulta local; sólo las
+    órdenes que todavía no están en la tabla se piden una a una.
+    """
+
+    def __init__(self, client, path: str = TN_SYNC_DB_PATH, interval_seconds: int = TN_SYNC_INTERVAL_SECONDS):
+        self.client = client
+        self.path = path
+        self.interval_seconds = interval_seconds
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        self._thread = None
+        self.last_sync_stats = {}
+        self.last_enrichment_stats = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tn_orders ("
+                " id INTEGER PRIMARY KEY,"
+                " number INTEGER,"
+                " updated_at TEXT,"
+                " shipping_address TEXT)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS tn_sync_state (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _get_state(self, key: str):
+        row = self._connection().execute("SELECT value FROM tn_sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _upsert_orders(self, orders: list):
+        rows = [
+            # Sin dirección se guarda NULL para que el enriquecimiento use el fallback de GlobalBluepoint
+            (order['id'], order.get('number'), order.get('updated_at'),
+             json.dumps(order['shipping_address']) if order.get('shipping_address') else None)
+            for order in orders if order.get('id') is not None
+        ]
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT INTO tn_orders (id, number, updated_at, shipping_address) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET number = excluded.number, updated_at = excluded.updated_at, "
+                "shipping_address = excluded.shipping_address",
+                rows
+            )
+        return len(rows)
+
+    def _claim_sync(self, force: bool) -> bool:
+        # Varios workers de gunicorn comparten la tabla y arrancan a la vez: leer y marcar last_sync_epoch
+        # en una misma transacción BEGIN IMMEDIATE hace que sólo uno de ellos sincronice en cada ciclo
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM tn_sync_state WHERE key = 'last_sync_epoch'").fetchone()
+            last_sync_epoch = float(row[0]) if row else 0
+            if not force and time.time() - last_sync_epoch < self.interval_seconds:
+                conn.rollback()
+                return False
+            self._touch_sync_epoch(conn)
+            conn.commit()
+            return True
+        except BaseException:
+            conn.rollback()
+            raise
+
+    @staticmethod
+    def _touch_sync_epoch(conn):
+        conn.execute("INSERT OR REPLACE INTO tn_sync_state (key, value) VALUES ('last_sync_epoch', ?)", (str(time.time()),))
+
+    def sync(self, force: bool = False) -> dict:
+        with self._sync_lock:
+            if not self._claim_sync(force):
+                return self.last_sync_stats
+
+            started_at = datetime.datetime.now(datetime.timezone.utc)
+            updated_at_min = self._get_state('updated_at_min') or \
+                (started_at - datetime.timedelta(days=TN_SYNC_INITIAL_DAYS)).isoformat()
+
+            pages = 0
+            upserted = 0
+            page = 1
+            while True:
+                orders = self.client.list_orders(updated_at_min=updated_at_min, page=page, per_page=TN_SYNC_PAGE_SIZE)
+                if orders is None:
+                    logging.error(f"Sincronización TiendaNube interrumpida en la página {page}. Se reintentará en el próximo ciclo.")
+                    self.last_sync_stats = {'ok': False, 'paginas': pages, 'ordenes': upserted, 'desde': updated_at_min}
+                    return self.last_sync_stats
+                pages += 1
+                upserted += self._upsert_orders(orders)
+                # Renovar la marca en cada página para que otro worker no empiece mientras se recorre una ventana larga
+                with self._connection() as conn:
+                    self._touch_sync_epoch(conn)
+                if len(orders) < TN_SYNC_PAGE_SIZE:
+                    break
+                page += 1
+
+            next_min = (started_at - datetime.timedelta(seconds=TN_SYNC_OVERLAP_SECONDS)).isoformat()
+            with self._connection() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tn_sync_state (key, value) VALUES (?, ?)",
+                    [('updated_at_min', next_min), ('last_sync_epoch', str(time.time()))]
+                )
+
+            self.last_sync_stats = {
+                'ok': True, 'paginas': pages, 'ordenes': upserted, 'desde': updated_at_min,
+                'finalizado': time.time(),
+            }
+            logging.info(f"Sincronización TiendaNube completa: {upserted} órdenes actualizadas en {pages} página(s) desde {updated_at_min}.")
+            return self.last_sync_stats
+
+    def get_orders(self, order_ids) -> tuple:
+        # Devuelve (órdenes por id, ids que no se pudieron consultar porque TiendaNube no estaba disponible)
+        order_ids = set(order_ids)
+        if not order_ids:
+            return {}, set()
+
+        found = {}
+        ids = list(order_ids)
+        conn = self._connection()
+        for i in range(0, len(ids), 500):  # límite de parámetros de SQLite
+            chunk = ids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT id, number, shipping_address FROM tn_orders WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for order_id, number, shipping_address in rows:
+                found[order_id] = {'id': order_id, 'number': number}
+                if shipping_address:
+                    found[order_id]['shipping_address'] = json.loads(shipping_address)
+
+        # Órdenes que la sincronización todavía no vio (más viejas que la ventana inicial, o recién creadas)
+        missing = order_ids - set(found)
+        fetched = []
+        skipped = set()
+        for order_id in missing:
+            try:
+                order_details = self.client.get_order_details(order_id)
+            except UpstreamUnavailableError as e:
+                logging.warning(f"TiendaNube no consultado para la orden {order_id}: {e}")
+                skipped.add(order_id)
+                continue
+            if order_details:
+                fetched.append(order_details)
+                found[order_id] = order_details
+        if fetched:
+            self._upsert_orders(fetched)
+
+        self.last_enrichment_stats = {
+            'ordenes': len(order_ids),
+            'desde_tabla_local': len(order_ids) - len(missing),
+            'consultas_remotas': len(missing),
+            'solicitudes_ahorradas': len(order_ids) - len(missing),
+            'sin_consultar': len(skipped),
+            'finalizado': time.time(),
+        }
+        logging.info(f"Enriquecimiento TiendaNube: {len(order_ids) - len(missing)} de {len(order_ids)} órdenes desde la tabla local, {len(missing)} consultas remotas.")
+        return found, skipped
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.sync()
+                except Exception as e:
+                    logging.error(f"Error inesperado en la sincronización de TiendaNube: {e}", exc_info=True)
+                time.sleep(self.interval_seconds)
+
+        self._thread = threading.Thread(target=loop, name="tiendanube-sync", daemon=True)
+        self._thread.start()
+        logging.info(f"Sincronización de TiendaNube en segundo plano cada {self.interval_seconds} segundos.")
+
+    def status(self) -> dict:
+        count = self._connection().execute("SELECT COUNT(*) FROM tn_orders").fetchone()[0]
+        return {
+            'ordenes_locales': count,
+            'desde': self._get_state('updated_at_min'),
+            'ultima_sincronizacion': self.last_sync_stats,
+            'ultimo_enriquecimiento': self.last_enrichment_stats,
+        }
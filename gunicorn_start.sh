@@ -15,8 +15,9 @@ export FLASK_APP=backend.app
 # Iniciar Gunicorn
 # -w: número de workers (se recomienda 2*CPU + 1)
 # -b: dirección y puerto de escucha
+# -c: configuración con --preload y calentamiento de clientes en cada worker (backend/gunicorn_conf.py)
 # backend.app: el módulo de tu aplicación Flask (backend es la carpeta, app es el archivo app.py)
-exec gunicorn --workers 3 --bind 0.0.0.0:8000 "backend.app:app"
+exec gunicorn -c "$PROJECT_ROOT/backend/gunicorn_conf.py" --workers 3 --bind 0.0.0.0:8000 "backend.app:app"
 
 # Desactivar el entorno virtual (no se ejecutará si se usa exec, pero es buena práctica)
 deactivate